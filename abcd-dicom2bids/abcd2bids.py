@@ -20,11 +20,16 @@ Updated 2024-10-15 - Tanya Pandhi
 ##################################
 
 import argparse
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import configparser
 from cryptography.fernet import Fernet
 import datetime
 from getpass import getpass
 import glob
+import hashlib
+import logging
+import numpy as np
 import os
 import pandas as pd
 import shutil
@@ -53,11 +58,45 @@ SERIES_TABLE_PARSER = os.path.join(PWD, "src", "s3_downloader_revised.py")
 SPREADSHEET_DOWNLOAD = os.path.join(PWD, "spreadsheets", "abcd_fastqc01_reformatted.csv")
 SPREADSHEET_QC = os.path.join(PWD, "spreadsheets", "abcd_fastqc01.txt")
 TEMP_FILES_DIR = os.path.join(PWD, "temp")
+CHECKPOINTS_FOLDER = ".checkpoints"
+QC_CACHE_VERSION = 2  # Increase whenever read_qc_spreadsheet's output changes
+SESSION_CHECKPOINTS_SUFFIX = "_sessions"  # Step's per-session markers folder
 UNPACK_AND_SETUP = os.path.join(PWD, "src", "unpack_and_setup.sh")
 UNPACKED_FOLDER = os.path.join(PWD, "data")
 MODALITIES = ['anat', 'func', 'dwi']
 SESSIONS = ['baseline_year_1_arm_1', '2_year_follow_up_y_arm_1', '00A', '02A', '04A', '06A', '08A']
 
+# Constants: Prefix of the file path of each QC SeriesType's .tgz file in the
+# S3 bucket (the DICOM filename suffix and extension are appended to it), and
+# the task SeriesTypes that also have an EventRelatedInformation.txt file
+SERIES_FILE_PATH_PREFIXES = {
+    'T1_NORM': 'anat/ABCD-T1-NORM_run-',
+    'T1': 'anat/ABCD-T1_run-',
+    'T2_NORM': 'anat/ABCD-T2-NORM_run-',
+    'T2': 'anat/ABCD-T2_run-',
+    'dMRI': 'dwi/ABCD-DTI_run-',
+    'dMRI_FM_AP': 'fmap/ABCD-Diffusion-FM-AP_run-',
+    'dMRI_FM_PA': 'fmap/ABCD-Diffusion-FM-PA_run-',
+    'fMRI_FM_AP': 'fmap/ABCD-fMRI-FM-AP_run-',
+    'fMRI_FM_PA': 'fmap/ABCD-fMRI-FM-PA_run-',
+    'fMRI_FM': 'fmap/ABCD-fMRI-FM_run-',
+    'dMRI_FM': 'fmap/ABCD-Diffusion-FM_run-',
+    'rsfMRI': 'func/ABCD-rsfMRI_run-',
+    'fMRI_nBack_task': 'func/ABCD-nBack-fMRI_run-',
+    'fMRI_MID_task': 'func/ABCD-MID-fMRI_run-',
+    'fMRI_SST_task': 'func/ABCD-SST-fMRI_run-'
+}
+EVENT_RELATED_SERIES_TYPES = ['fMRI_nBack_task', 'fMRI_MID_task', 'fMRI_SST_task']
+
+# Constant: Imaging modality that each QC SeriesType is downloaded as part of
+SERIES_MODALITIES = {
+    'T1_NORM': 'anat', 'T1': 'anat', 'T2_NORM': 'anat', 'T2': 'anat',
+    'dMRI': 'dwi', 'dMRI_FM_AP': 'dwi', 'dMRI_FM_PA': 'dwi', 'dMRI_FM': 'dwi',
+    'fMRI_FM_AP': 'func', 'fMRI_FM_PA': 'func', 'fMRI_FM': 'func',
+    'rsfMRI': 'func', 'fMRI_nBack_task': 'func', 'fMRI_MID_task': 'func',
+    'fMRI_SST_task': 'func'
+}
+
 
 def main():
     """
@@ -66,21 +105,53 @@ def main():
     :return: N/A
     """
     cli_args = get_cli_args()
+    logging.basicConfig(format="%(asctime)s %(message)s",
+                        level=logging.WARNING if cli_args.quiet
+                        else logging.INFO)
     starting_timestamp = get_and_print_timestamp_when(sys.argv[0], "started")
 
     # Set cleanup function to delete all temporary files if script crashes
     if cli_args.remove:
         set_to_cleanup_on_crash(cli_args.temp)
 
-    # Run all steps sequentially, starting at the one specified by the user
+    # Run all steps sequentially, starting at the one specified by the user.
+    # Skip any step which an earlier (crashed) run with the same inputs
+    # already finished, unless the user explicitly said to start at it
+    checkpoint_dir = get_checkpoint_dir(cli_args)
+    os.makedirs(checkpoint_dir, exist_ok=True)
     started = False
     for step in STEP_NAMES:
-        if step == cli_args.start_at:
+        if step == (cli_args.start_at or STEP_NAMES[0]):
             started = True
         if started:
+            checkpoint = os.path.join(checkpoint_dir, step)
+            already_finished = os.path.isfile(checkpoint)
+            if step == "reformat_fastqc_spreadsheet":  # Its output is needed
+                already_finished = already_finished and os.path.isfile(
+                    get_download_spreadsheet(cli_args)
+                )
+            if already_finished and step != cli_args.start_at:
+                print("\nSkipping the {} step because it was already finished "
+                      "by an earlier run".format(step))
+                continue
+
+            # Rerunning this step changes the input of every step after it,
+            # so none of their (or their sessions') old markers still hold.
+            # Forcing this step to rerun also reruns all of its sessions
+            if step == cli_args.start_at:
+                shutil.rmtree(checkpoint + SESSION_CHECKPOINTS_SUFFIX,
+                              ignore_errors=True)
+            for later_step in STEP_NAMES[STEP_NAMES.index(step) + 1:]:
+                later_checkpoint = os.path.join(checkpoint_dir, later_step)
+                if os.path.isfile(later_checkpoint):
+                    os.remove(later_checkpoint)
+                shutil.rmtree(later_checkpoint + SESSION_CHECKPOINTS_SUFFIX,
+                              ignore_errors=True)
+
             get_and_print_timestamp_when("The {} step".format(step),
                                          "started")
             globals()[step](cli_args)
+            open(checkpoint, "w").close()
             get_and_print_timestamp_when("The {} step".format(step),
                                          "finished")
     print(starting_timestamp)
@@ -90,6 +161,41 @@ def main():
     cleanup(cli_args.temp, 0)
 
 
+def get_checkpoint_dir(cli_args):
+    """
+    Get the path to the folder in which to mark which steps (and which subject
+    sessions of the unpack_and_setup step) have been finished. Runs share it
+    only if they have the same inputs, and it is deleted with the other
+    temporary files once the wrapper finishes.
+    :param cli_args: argparse namespace containing all CLI arguments.
+    :return: String, the path to the checkpoint folder for these CLI arguments
+    """
+    run_inputs = [str(getattr(cli_args, cli_arg)) for cli_arg in (
+        "qc", "subject_list", "sessions", "modalities", "download", "output",
+        "s3bucket"
+    )]
+    for input_file in (cli_args.qc, cli_args.subject_list):
+        input_stat = os.stat(input_file)
+        run_inputs.append("{}:{}".format(input_stat.st_mtime,
+                                         input_stat.st_size))
+    return os.path.join(cli_args.temp, CHECKPOINTS_FOLDER, hashlib.sha1(
+        "\n".join(run_inputs).encode()
+    ).hexdigest())
+
+
+def get_download_spreadsheet(cli_args):
+    """
+    Get the path to the reformatted QC spreadsheet listing this run's files to
+    download. It is kept in the run's checkpoint folder, because it only has
+    the subjects, sessions, and modalities given to this run.
+    :param cli_args: argparse namespace containing all CLI arguments.
+    :return: String, the path to the download spreadsheet for these CLI
+             arguments
+    """
+    return os.path.join(get_checkpoint_dir(cli_args),
+                        os.path.basename(SPREADSHEET_DOWNLOAD))
+
+
 def get_and_print_timestamp_when(script, did_what):
     """
     Print and return a string showing the exact date and time when a script
@@ -222,6 +328,37 @@ def get_cli_args():
              "The possible selections are {}".format(MODALITIES))
 )    
 
+    # Optional: Number of subject sessions to unpack and setup at once
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=os.cpu_count(),
+        help=("Number of subject sessions to unpack and setup in parallel "
+              "during the unpack_and_setup step. By default, this is the "
+              "number of CPUs on this machine.")
+    )
+
+    # Optional: Run each Python script called by this wrapper in its own
+    # Python process, like older versions of this wrapper did
+    parser.add_argument(
+        "--subprocess-steps",
+        action="store_true",
+        dest="subprocess_steps",
+        help=("Run correct_jsons.py as a separate script during the "
+              "correct_jsons step, instead of running it within this "
+              "wrapper's own Python process.")
+    )
+
+    # Optional: Hide the progress messages for each subject and session
+    parser.add_argument(
+        "--quiet",
+        action="store_true",
+        help=("Do not print the progress messages logged for each subject "
+              "and session during the unpack_and_setup and correct_jsons "
+              "steps. Warnings and errors are still printed.")
+    )
+
     # Optional: During unpack_and_setup, remove unprocessed data
     parser.add_argument(
         "-r",
@@ -237,11 +374,14 @@ def get_cli_args():
         "-s",
         "--start_at",
         choices=STEP_NAMES,
-        default=STEP_NAMES[0],
+        default=None,
         help=("Give the name of the step in the wrapper to start "
               "at, then run that step and every step after it. Here are the "
               "names of all of the steps, in order from first to last: "
-              + ", ".join(STEP_NAMES))
+              + ", ".join(STEP_NAMES) + ". By default, the wrapper starts at "
+              "the first step, but skips every step (and every subject "
+              "session of unpack_and_setup) that was already finished by an "
+              "earlier run with the same inputs which crashed.")
     )
 
     # Optional: Get folder to place temp data into during unpacking
@@ -355,24 +495,14 @@ def try_to_create_and_prep_directory_at(folder_path, default_path, parser):
     if os.path.abspath(folder_path) != default:
         for each_file in os.scandir(default):
             if not each_file.is_dir():
-                #shutil.copy2(each_file.path, folder_path)
+                # shutil.copyfile already copies within the kernel (without
+                # reading the file into Python) on platforms that support it
                 try:
-                    shutil.copyfile(each_file.path, os.path.join(folder_path, each_file.name))
-                # If source and destination are same
-                except shutil.SameFileError:
-                    print("Source and destination represents the same file.")
-                 
-                # If destination is a directory.
-                except IsADirectoryError:
-                    print("Destination is a directory.")
-                 
-                # If there is any permission issue
-                except PermissionError:
-                    print("Permission denied.")
-                 
-                # For other errors
-                except:
-                    print("Error occurred while copying file.")
+                    shutil.copyfile(each_file.path,
+                                    os.path.join(folder_path, each_file.name))
+                except OSError as e:
+                    print("Error occurred while copying {} to {}: {}"
+                          .format(each_file.path, folder_path, e))
 
 
 def set_to_cleanup_on_crash(temp_dir):
@@ -404,9 +534,13 @@ def cleanup(temp_dir, exit_code):
     called when wrapper finishes successfully, then 0; otherwise 1.
     :return: N/A
     """
-    # Delete all temp folder subdirectories, but not the README in temp folder
+    # Delete all temp folder subdirectories, but not the README in temp folder.
+    # If the wrapper crashed, keep the marks of what it finished so that
+    # rerunning it can resume where it stopped
     for temp_dir_subdir in os.scandir(temp_dir):
-        if temp_dir_subdir.is_dir():
+        if temp_dir_subdir.is_dir() and not (
+                exit_code != 0 and temp_dir_subdir.name == CHECKPOINTS_FOLDER
+        ):
             shutil.rmtree(temp_dir_subdir.path)
 
     # Inform user that temporary files were deleted, then terminate wrapper
@@ -421,37 +555,45 @@ def reformat_fastqc_spreadsheet(cli_args):
     :param cli_args: argparse namespace containing all CLI arguments.
     :return: N/A
     """   
-    # Import QC data from .csv file
-    with open(cli_args.qc) as qc_file:
-        all_qc_data = pd.read_csv(
-            qc_file, encoding="utf-8-sig", sep=",|\t", engine="python",
-            index_col=False, header=0 # Skip row 2 (description)
-        )
-    print("Print Columns:", all_qc_data.columns)
-    
-
-    ################# original code ############################
-    # # Remove quotes from values and convert int-strings to ints
-    # all_qc_data = all_qc_data.applymap(lambda x: x.strip('"')).apply(
-    #     lambda x: x.apply(lambda y: int(y) if y.isnumeric() else y)
-    # )
-    ##############################################################
-
-    ################## added for new fasttrackqc - tanya pandhi ###############
-    all_qc_data = all_qc_data.applymap(lambda x: x.strip('"') if isinstance(x, str) else x)
-    all_qc_data = all_qc_data.applymap(lambda x: int(x) if isinstance(x, str) and x.isnumeric() else x)
-    
-    # Remove quotes from headers
-    new_headers = []
-    for header in all_qc_data.columns: # data.columns is your list of headers
-        header = header.strip('"') # Remove the quotes off each header
-        new_headers.append(header) # Save the new strings without the quotes
-    all_qc_data.columns = new_headers # Replace the old headers with the new list
-    print(all_qc_data.columns)
+    # Reuse the QC data parsed by a previous run unless the QC spreadsheet (or
+    # the way it is parsed) has changed since then, because parsing it is the
+    # slowest part of this step
+    qc_stat = os.stat(cli_args.qc)
+    qc_cache = os.path.join(cli_args.temp, "qc_{}.pkl".format(hashlib.sha1(
+        "{}:{}:{}:{}".format(cli_args.qc, qc_stat.st_mtime, qc_stat.st_size,
+                             QC_CACHE_VERSION).encode()
+    ).hexdigest()))
+    all_qc_data = None
+    if os.path.exists(qc_cache):
+        print("Using QC data already parsed from {} at {}"
+              .format(cli_args.qc, qc_cache))
+        try:
+            all_qc_data = pd.read_pickle(qc_cache)
+        except Exception as e:  # Unpickling can fail in many different ways
+            print("Could not read parsed QC data at {}, so parsing {} again: "
+                  "{}".format(qc_cache, cli_args.qc, e))
+    if all_qc_data is None:
+        all_qc_data = read_qc_spreadsheet(cli_args.qc)
+
+        # Replace any outdated (or unreadable) parsed QC data with the newly
+        # parsed QC data. Write it under a temporary name unique to this run
+        # first, so that it only gets its real name once it is complete, and
+        # so that other runs writing their own parsed QC data are left alone
+        for old_qc_cache in glob.iglob(os.path.join(cli_args.temp,
+                                                    "qc_*.pkl")):
+            try:
+                os.remove(old_qc_cache)
+            except FileNotFoundError:  # Already removed by another run
+                pass
+        partial_qc_cache = "{}.{}.tmp".format(qc_cache, os.getpid())
+        all_qc_data.to_pickle(partial_qc_cache)
+        os.replace(partial_qc_cache, qc_cache)
 
     # Filter QC data for 'Complete' != 0 and 'ABCD_compliant' != 0 'Bad'
+    # (blank values in integer columns are <NA>, and are not filtered out)
     filtered_qc_data = all_qc_data[
-        (all_qc_data['Completed'] != 0) & (all_qc_data['ABCD_Compliant'] != 'Bad')
+        ((all_qc_data['Completed'] != 0) &
+         (all_qc_data['ABCD_Compliant'] != 'Bad')).fillna(True).astype(bool)
     ]
 
     # Select only the required columns
@@ -463,82 +605,139 @@ def reformat_fastqc_spreadsheet(cli_args):
     # Create a new DataFrame with only the required columns
     reformatted_data = filtered_qc_data[required_columns].copy()
 
-    # Pad SeriesTime to 6 digits, convert it to an integer (to remove .0), and then to string
-    reformatted_data['SeriesTime'] = reformatted_data['SeriesTime'].apply(
-        lambda x: str(int(x)).zfill(6) if pd.notna(x) else '000000'
-    )
+    # Store the columns with few distinct (repeated) values as categoricals
+    categorical_columns = ('pGUID', 'VisitID', 'EventName', 'SeriesType',
+                           'ABCD_Compliant')
+    for col in categorical_columns:
+        reformatted_data[col] = reformatted_data[col].astype('category')
+
+    # Keep only the subjects, sessions, and modalities to download, so that
+    # the downloader only reads the rows it will use. Subject and session IDs
+    # are compared without their 'sub-'/'ses-' prefixes or underscores, so that
+    # e.g. NDAR_INV00000000 matches sub-NDARINV00000000 in the subject list
+    with open(cli_args.subject_list) as subject_file:
+        subjects = pd.Index(subject_file.read().split()).str.replace(
+            r'^sub-|_', '', regex=True
+        )
+    pguids = reformatted_data['pGUID'].cat.categories
+    events = reformatted_data['EventName'].cat.categories
+    reformatted_data = reformatted_data[
+        reformatted_data['pGUID'].isin(pguids[pguids.str.replace(
+            r'^sub-|_', '', regex=True
+        ).isin(subjects)]) &
+        reformatted_data['EventName'].isin(events[events.str.replace(
+            r'^ses-', '', regex=True
+        ).isin(cli_args.sessions)]) &
+        reformatted_data['SeriesType'].map(
+            SERIES_MODALITIES
+        ).isin(cli_args.modalities)
+    ].copy()
+    for col in categorical_columns:
+        reformatted_data[col] = reformatted_data[col].cat.remove_unused_categories()
 
-    # Create 'dicom_filename_ends_with'
+    # Pad SeriesTime to 6 digits, convert it to an integer (to remove .0), and then to string
+    reformatted_data['SeriesTime'] = np.char.zfill(reformatted_data[
+        'SeriesTime'
+    ].fillna(0).to_numpy(dtype='int64').astype(str), 6)
+
+    # Create 'dicom_filename_ends_with'. Rows without a StudyDate cannot be
+    # matched to their DICOM files, so they get none (and no file_path)
+    reformatted_data['StudyDate'] = pd.to_numeric(
+        reformatted_data['StudyDate'], errors='coerce'
+    ).astype('Int64')
+    study_date = reformatted_data['StudyDate']
     reformatted_data['dicom_filename_ends_with'] = (
-        reformatted_data['StudyDate'].astype(str) + reformatted_data['SeriesTime']
-    ).astype(str).str.split('.').str[0]
+        study_date.astype(str) + reformatted_data['SeriesTime']
+    ).where(study_date.notna())
 
     # Add 'file_path' column based on SeriesType and dicom_filename_ends_with
-    def determine_file_path(row):
-        series_type = row['SeriesType']
-        filename_suffix = row['dicom_filename_ends_with']
-        base_path = None
-        if series_type == 'T1_NORM':
-            base_path=f'anat/ABCD-T1-NORM_run-{filename_suffix}.dicom.tgz'
-        elif series_type == 'T1':
-            base_path=f'anat/ABCD-T1_run-{filename_suffix}.dicom.tgz'
-        elif series_type == 'T2_NORM':
-            base_path=f'anat/ABCD-T2-NORM_run-{filename_suffix}.dicom.tgz'
-        elif series_type == 'T2':
-            base_path=f'anat/ABCD-T2_run-{filename_suffix}.dicom.tgz'
-        elif series_type == 'dMRI':
-            base_path=f'dwi/ABCD-DTI_run-{filename_suffix}.dicom.tgz'
-        elif series_type in [
-            'dMRI_FM_AP', 'dMRI_FM_PA'
-        ]:
-            base_path=f'fmap/ABCD-Diffusion-FM-{series_type.split("_")[-1]}_run-{filename_suffix}.dicom.tgz'
-        elif series_type in ['fMRI_FM_AP', 'fMRI_FM_PA']:
-            base_path=f'fmap/ABCD-fMRI-FM-{series_type.split("_")[-1]}_run-{filename_suffix}.dicom.tgz'
-        elif series_type in ['fMRI_FM']:
-            base_path=f'fmap/ABCD-fMRI-FM_run-{filename_suffix}.dicom.tgz'
-        elif series_type in ['dMRI_FM']:
-            base_path=f'fmap/ABCD-Diffusion-FM_run-{filename_suffix}.dicom.tgz'
-        elif series_type == 'rsfMRI':
-            base_path = f'func/ABCD-{series_type}_run-{filename_suffix}.dicom.tgz'
-        elif series_type in ['fMRI_nBack_task', 'fMRI_MID_task', 'fMRI_SST_task']:
-            # Extract the task name from the series_type
-            task_name = series_type.split('_')[1]  # This gets 'nBack', 'MID', or 'SST'
-            
-            # Create the cleaned series type by replacing 'fMRI' with the task name
-            cleaned_series_type = task_name + '-fMRI'
-            
-            # Create the base path using the new format
-            base_path = f'func/ABCD-{cleaned_series_type}_run-{filename_suffix}.dicom.tgz'
-            
-        # Create the paths for json and EventRelatedInformation.txt
-        json_path = base_path.replace('.dicom.tgz', '.json') if base_path else None
-        event_related_info_path = (
-            base_path.replace('.dicom.tgz', '-EventRelatedInformation.txt') 
-            if series_type in ['fMRI_nBack_task', 'fMRI_MID_task', 'fMRI_SST_task'] 
-            else None
-        )
+    series_type = reformatted_data['SeriesType']
+    # (mapping the categorical SeriesType only maps its few categories)
+    file_stem = (series_type.map(SERIES_FILE_PATH_PREFIXES).astype(object) +
+                 reformatted_data['dicom_filename_ends_with'])
+
+    # Create the paths for the .tgz, json and EventRelatedInformation.txt
+    # files by appending each file's ending to the same stem; unknown
+    # SeriesTypes get no file_path
+    file_path = file_stem + '.dicom.tgz;' + file_stem + '.json'
+    has_event_info = series_type.isin(EVENT_RELATED_SERIES_TYPES)
+    file_path.loc[has_event_info] = (file_path[has_event_info] + ';' +
+                                     file_stem[has_event_info] +
+                                     '-EventRelatedInformation.txt')
+    reformatted_data['file_path'] = file_path
+
+    # Sort the DataFrame by pGUID, EventName, SeriesDescription, and then
+    # file_path, comparing the integer (categorical) codes of their values
+    # instead of the strings; missing values go last, like in sort_values
+    sort_keys = []
+    for col in ('file_path', 'SeriesDescription', 'EventName', 'pGUID'):
+        categorical = reformatted_data[col].astype('category').cat
+        codes = categorical.codes.to_numpy()
+        sort_keys.append(np.where(codes < 0, len(categorical.categories), codes))
+    reformatted_data = reformatted_data.iloc[np.lexsort(sort_keys)]
+    
+    # Save the reformatted data where only runs with the same inputs use it,
+    # under a temporary name until it is complete
+    spreadsheet_download = get_download_spreadsheet(cli_args)
+    os.makedirs(os.path.dirname(spreadsheet_download), exist_ok=True)
+    partial_spreadsheet = "{}.{}.tmp".format(spreadsheet_download, os.getpid())
+    reformatted_data.to_csv(partial_spreadsheet, index=False)
+    os.replace(partial_spreadsheet, spreadsheet_download)
+    print(f'Reformatted data saved to {spreadsheet_download}')
 
-        # Build the final output
-        if base_path:
-            if event_related_info_path:
-                return f"{base_path};{json_path};{event_related_info_path}"
-            return f"{base_path};{json_path}"
-        
-        return None
-
-    reformatted_data['file_path'] = reformatted_data.apply(determine_file_path, axis=1)
-
-    # Sort the DataFrame
-    reformatted_data = reformatted_data.sort_values([
-        'pGUID',
-        'EventName',
-        'SeriesDescription',
-        'file_path'
-    ])
+
+def read_qc_spreadsheet(qc_path):
+    """
+    Import the original fastqc01.txt QC spreadsheet and clean up its values.
+    :param qc_path: String, the path to the QC spreadsheet file
+    :return: pandas.DataFrame with all QC data
+    """
+    # Check whether the QC file is tab- or comma-separated, so that it can be
+    # parsed by the C engine (a separator regex needs the slow Python engine)
+    with open(qc_path, "rb") as qc_file:
+        header_row = qc_file.readline()
+    separator = "\t" if header_row.count(b"\t") > header_row.count(b",") else ","
+
+    # Import QC data from .csv file
+    all_qc_data = pd.read_csv(
+        qc_path, encoding="utf-8-sig", sep=separator, engine="c",
+        low_memory=False, index_col=False, header=0 # Skip row 2 (description)
+    )
+    print("Print Columns:", all_qc_data.columns)
     
-    # Save the reformatted data
-    reformatted_data.to_csv(SPREADSHEET_DOWNLOAD, index=False)
-    print(f'Reformatted data saved to {SPREADSHEET_DOWNLOAD}')
+
+    ################# original code ############################
+    # # Remove quotes from values and convert int-strings to ints
+    # all_qc_data = all_qc_data.applymap(lambda x: x.strip('"')).apply(
+    #     lambda x: x.apply(lambda y: int(y) if y.isnumeric() else y)
+    # )
+    ##############################################################
+
+    ################## added for new fasttrackqc - tanya pandhi ###############
+    # Remove quotes from values and convert numeric strings to numbers, one
+    # whole column at a time instead of one cell at a time
+    for col in all_qc_data.select_dtypes(include=["object", "float"]).columns:
+        if all_qc_data[col].dtype == object:
+            stripped = all_qc_data[col].str.strip('"')
+            converted = pd.to_numeric(stripped, errors="coerce")
+        else:  # Already parsed as numbers by read_csv
+            stripped = converted = all_qc_data[col]
+        is_number = converted.notna()
+
+        # Blanks make to_numeric return floats, so keep whole numbers as ints
+        if converted.dtype.kind == "f" and is_number.any() and \
+                (converted[is_number] % 1 == 0).all():
+            converted = converted.astype("Int64")
+
+        # Keep the values which are not numbers as strings
+        if stripped[~is_number].notna().any():
+            converted = converted.astype(object).where(is_number, stripped)
+        all_qc_data[col] = converted
+
+    # Remove quotes from headers
+    all_qc_data.columns = all_qc_data.columns.str.strip('"')
+    print(all_qc_data.columns)
+    return all_qc_data
 
 
 def fix_split_col(qc_df):
@@ -548,24 +747,17 @@ def fix_split_col(qc_df):
     :param qc_df: pandas.DataFrame with all QC data
     :return: pandas.DataFrame which is qc_df, but with the last column(s) fixed
     """
-    def trim_end_columns(row):
-        """
-        Local function to check for extra columns in a row, and fix them
-        :param row: pandas.Series which is one row in the QC DataFrame
-        :param columns: List of strings where each is the name of a column in
-        the QC DataFrame, in order
-        :return: N/A
-        """
-        ix = int(row.name)
-        if not pd.isna(qc_df.at[ix, columns[-1]]):
-            qc_df.at[ix, columns[-3]] += " " + qc_df.at[ix, columns[-2]]
-            qc_df.at[ix, columns[-2]] = qc_df.at[ix, columns[-1]]
-
     # Keep checking and dropping the last column of qc_df until it's valid
     columns = qc_df.columns.values.tolist()
     last_col = columns[-1]
     while any(qc_df[last_col].isna()):
-        qc_df.apply(trim_end_columns, axis="columns")
+        # In every row with an extra column, merge the last 2 real columns
+        # and shift the value in the extra column into the last real column
+        spilled = qc_df[last_col].notna()
+        qc_df.loc[spilled, columns[-3]] = (qc_df.loc[spilled, columns[-3]]
+                                           + " " + qc_df.loc[spilled, columns[-2]])
+        qc_df.loc[spilled, columns[-2]] = qc_df.loc[spilled, columns[-1]]
+
         print("Dropping '{}' column because it has NaNs".format(last_col))
         qc_df = qc_df.drop(last_col, axis="columns")
         columns = qc_df.columns.values.tolist()
@@ -581,11 +773,19 @@ def download_s3_data(cli_args):
     with downloaded NDA data.
     :return: N/A
     """
-    subprocess.check_call(("python3", "--version"))
+    # Make this run's download spreadsheet first if starting at this step
+    # without an earlier run with the same inputs having made it
+    spreadsheet_download = get_download_spreadsheet(cli_args)
+    if not os.path.isfile(spreadsheet_download):
+        print("No download spreadsheet at {}, so making it first"
+              .format(spreadsheet_download))
+        reformat_fastqc_spreadsheet(cli_args)
+
+    print("Python " + sys.version.split()[0])
     print(cli_args.modalities)
-    subprocess.check_call(("python3", 
+    subprocess.check_call((sys.executable,
                             SERIES_TABLE_PARSER,
-                            "--qc-csv", SPREADSHEET_DOWNLOAD,
+                            "--qc-csv", spreadsheet_download,
                             "--download-dir", cli_args.download, 
                             "--subject-list", cli_args.subject_list,
                             "--sessions", ','.join(cli_args.sessions),
@@ -604,65 +804,99 @@ def unpack_and_setup(args):
     :return: N/A
     """
 
-    # Create list of all subject directories for setup
+    # Create list of all subject directories for setup, reading the download
+    # folder once instead of checking each listed subject's folder separately
+    downloaded_subjects = {subject.name for subject in os.scandir(args.download)
+                           if subject.is_dir()}
     subject_dir_paths = {}
     if args.subject_list:
-        f = open(args.subject_list, 'r')
-        x = f.readlines()
-        f.close
-        subject_list = [sub.strip() for sub in x]
+        with open(args.subject_list, 'r') as f:
+            subject_list = [line.strip() for line in f if line.strip()]
         for subject in subject_list:
-            uid_start = "INV"
-            # uid = subject.split(uid_start, 1)[1]
+            # uid = subject.split("INV", 1)[1]
             # bids_pid = 'sub-NDARINV' + ''.join(uid)
-            bids_pid = 'sub-' + ''.join(subject)
-            print("bids_pid:", bids_pid)
-            subject_dir = os.path.join(args.download, bids_pid)
-            if os.path.isdir(subject_dir):
-                subject_dir_paths[bids_pid] = subject_dir
+            bids_pid = 'sub-' + subject
+            logging.info("bids_pid: %s", bids_pid)
+            if bids_pid in downloaded_subjects:
+                subject_dir_paths[bids_pid] = os.path.join(args.download,
+                                                           bids_pid)
     else:
-        for subject in os.scandir(args.download):
-            if subject.is_dir():
-                subject_dir_paths[subject.name] = subject.path
-
-    # Loop through each subject and setup all sessions for that subject
+        for subject in downloaded_subjects:
+            subject_dir_paths[subject] = os.path.join(args.download, subject)
+
+    # Collect every session of each subject which has downloaded .tgz files
+    # in any of its modality folders, skipping the sessions which an earlier
+    # run already set up
+    checkpoint_dir = os.path.join(get_checkpoint_dir(args), "unpack_and_setup"
+                                  + SESSION_CHECKPOINTS_SUFFIX)
+    os.makedirs(checkpoint_dir, exist_ok=True)
+    sessions_to_setup = []
     for subject, subject_dir in subject_dir_paths.items():
-        for session_dir in os.scandir(subject_dir):
-            if session_dir.is_dir():
-                exit_modality_loop = False
-                for modality in os.scandir(session_dir):
-                    print(f"Unpacking {modality.name} folder")
-                    modality_dir = os.path.join(session_dir.path, modality)
-                    for file in os.scandir(modality_dir):
-                        if file:
-                            # Get session ID from some (arbitrary) .tgz file in
-                            # session folder
-                            session_name = session_dir.path.split("/")[-1]
-                            print("Session:", session_name)
-                            print('Unpacking and setting up tgzs for {} {} located here: {}'.format(subject, session_name, modality_dir))
-                            print("Running: ", UNPACK_AND_SETUP, subject, session_name, session_dir.path, args.output, args.temp, args.fsl_dir, args.mre_dir)
-
-                            # Unpack/setup the data for this subject/session
-                            subprocess.check_call((
-                                UNPACK_AND_SETUP,
-                                subject,
-                                session_name,
-                                session_dir.path,
-                                args.output,
-                                args.temp,
-                                args.fsl_dir,
-                                args.mre_dir
-                            ))
-                            # If user said to, delete all the raw downloaded
-                            # files for each subject after that subject's data
-                            # has been converted and copied
-                            if args.remove:
-                                shutil.rmtree(os.path.join(args.download,
-                                                        subject))
-                            exit_modality_loop = True
-                            break
-                    if exit_modality_loop:
-                        break  # Exit modality loop
+        session_dirs = set()
+        for tgz in glob.iglob(os.path.join(subject_dir, "*", "*", "*.tgz")):
+            session_dir = os.path.dirname(os.path.dirname(tgz))
+            if session_dir not in session_dirs:
+                session_dirs.add(session_dir)
+                session_name = os.path.basename(session_dir)
+                checkpoint = os.path.join(checkpoint_dir, "{}_{}".format(
+                    subject, session_name
+                ))
+                if not os.path.isfile(checkpoint):
+                    sessions_to_setup.append((subject, session_name,
+                                              session_dir, checkpoint))
+
+    # Count how many sessions of each subject still need to be set up, so
+    # that a subject's raw data is only deleted once all of them are done
+    sessions_left = defaultdict(int)
+    for subject, _, _, _ in sessions_to_setup:
+        sessions_left[subject] += 1
+
+    # Arguments of unpack_and_setup.sh which are the same for every session
+    shared_setup_args = (args.output, args.temp, args.fsl_dir, args.mre_dir)
+
+    # Unpack/setup the data for each subject/session, running up to
+    # args.jobs of the (independent) subject/session setups at once
+    with ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        futures = dict()
+        for subject, session_name, session_path, checkpoint \
+                in sessions_to_setup:
+            setup_cmd = (UNPACK_AND_SETUP, subject, session_name,
+                         session_path) + shared_setup_args
+            logging.info("Unpacking and setting up tgzs for %s %s located "
+                         "here: %s", subject, session_name, session_path)
+            logging.info("Running: %s %s %s %s %s %s %s %s", *setup_cmd)
+            futures[executor.submit(setup_session, setup_cmd,
+                                    checkpoint)] = subject
+
+        try:
+            for future in as_completed(futures):
+                future.result()  # Raise any error from unpack_and_setup.sh
+                subject = futures[future]
+
+                # If user said to, delete all the raw downloaded files for
+                # each subject after that subject's data has been converted
+                # and copied
+                sessions_left[subject] -= 1
+                if args.remove and not sessions_left[subject]:
+                    shutil.rmtree(os.path.join(args.download, subject))
+        except BaseException:
+            # Stop at the first failed session like running them one at a
+            # time would: only let the already running sessions finish
+            for future in futures:
+                future.cancel()
+            raise
+
+
+def setup_session(setup_cmd, checkpoint):
+    """
+    Run unpack_and_setup.sh for one subject session, then mark that session
+    as finished so that rerunning the wrapper will skip it
+    :param setup_cmd: Tuple of the unpack_and_setup.sh path and its arguments
+    :param checkpoint: String, path to the file marking the session finished
+    :return: N/A
+    """
+    subprocess.check_call(setup_cmd)
+    open(checkpoint, "w").close()
 
 
 def correct_jsons(cli_args):
@@ -673,18 +907,41 @@ def correct_jsons(cli_args):
     corrected NDA data to validate.
     :return: N/A
     """
-    subprocess.check_call((CORRECT_JSONS, cli_args.output))
+    if cli_args.subprocess_steps:
+        subprocess.check_call((CORRECT_JSONS, cli_args.output))
+    else:
+        # Run correct_jsons.py in this process instead of starting another
+        # Python interpreter (and re-importing its modules) just to run it
+        sys.path.insert(0, os.path.dirname(CORRECT_JSONS))
+        import correct_jsons as json_corrector
+        json_corrector.main((CORRECT_JSONS, cli_args.output))
 
     # Remove the .json files added to each subject's output directory by
-    # sefm_eval_and_json_editor.py, and the vol*.nii.gz files
-    sub_dirs = os.path.join(cli_args.output, "sub*")
-    for json_path in glob.iglob(os.path.join(sub_dirs, "*.json")):
-        print("Removing .JSON file: {}".format(json_path))
-        os.remove(json_path)
-    for vol_file in glob.iglob(os.path.join(sub_dirs, "ses*", 
-                          "fmap", "vol*.nii.gz")):
-        print("Removing 'vol' file: {}".format(vol_file))
-        os.remove(vol_file)
+    # sefm_eval_and_json_editor.py, and the vol*.nii.gz files. Find both kinds
+    # of files in one pass through each subject's directory
+    files_to_remove = []
+    for sub_dir in os.scandir(cli_args.output):
+        if sub_dir.name.startswith("sub") and sub_dir.is_dir():
+            for entry in os.scandir(sub_dir.path):
+                if entry.name.endswith(".json"):
+                    files_to_remove.append(entry.path)
+                elif entry.name.startswith("ses") and entry.is_dir():
+                    try:
+                        files_to_remove += [
+                            vol_file.path for vol_file in
+                            os.scandir(os.path.join(entry.path, "fmap"))
+                            if vol_file.name.startswith("vol")
+                            and vol_file.name.endswith(".nii.gz")
+                        ]
+                    except FileNotFoundError:  # Session has no fmap folder
+                        pass
+
+    # Remove many files at once, because each removal spends most of its time
+    # waiting on the disk
+    with ThreadPoolExecutor(max_workers=32) as executor:
+        list(executor.map(os.remove, files_to_remove))
+    logging.info("Removed %d .JSON and 'vol' files from %s",
+                 len(files_to_remove), cli_args.output)
 
 
 def validate_bids(cli_args):
@@ -69,7 +69,7 @@ def main(argv=sys.argv):
         '--version', '-v', action='version', version='%(prog)s ' + __version__
     )
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv[1:])
 
     for root, dirs, files in os.walk(args.BIDS_DIR):
         for filename in files:
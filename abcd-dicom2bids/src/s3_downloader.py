@@ -22,6 +22,7 @@ QC_CSV = os.path.join(os.path.dirname(os.path.dirname(
                     "abcd_fastqc01_reformatted.csv") 
 YEARS = ['baseline_year_1_arm_1', '2_year_follow_up_y_arm_1',  '00A', '02A', '04A', '06A', '08A']
 MODALITIES = ['anat', 'func', 'dwi']
+S3_CONFIG = '/spaces/ngdr/workspaces/hendr522/ABCC/code/s3cfgs/msi_loris_abcd_midb_s3.s3cfg'  # s3cmd config with S3 Bucket Credentials
 
 def generate_parser(parser=None):
 
@@ -207,21 +208,20 @@ def main(argv=sys.argv):
                         full_file_path = f"{args.s3_bucket}/{bids_id}/ses-{bids_year}/{split_value.strip()}"
                         print("Trying to Download",full_file_path)
                         # Check if the file exists in the S3 bucket
-                        result = subprocess.run(['s3cmd', 'ls', full_file_path, '-c', '/spaces/ngdr/workspaces/hendr522/ABCC/code/s3cfgs/msi_loris_abcd_midb_s3.s3cfg'], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+                        result = subprocess.run(['s3cmd', 'ls', full_file_path, '-c', S3_CONFIG], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
                         print(result.stdout.decode())
                         print(result.stderr.decode())
                         print(result.returncode)
 
                         if result.returncode == 0:
-                            # Extract the second last directory (e.g., "anat" from the full path)
-                            second_last_dir = full_file_path.split('/')[-2]
-                            file_name = full_file_path.split('/')[-1]
+                            # Extract the second last directory (e.g., "anat" from the full path) and file name
+                            (_, second_last_dir, file_name) = full_file_path.rsplit('/', 2)
                             
                             # Construct the destination directory
                             destination_dir = os.path.join(tgz_dir, second_last_dir,file_name)
                             # os.makedirs(destination_dir, exist_ok=True)  # Create the destination directory if it doesn't exist
                             try:
-                                subprocess.run(['s3cmd', 'get', full_file_path, destination_dir, '-c', '/spaces/ngdr/workspaces/hendr522/ABCC/code/s3cfgs/msi_loris_abcd_midb_s3.s3cfg'], check=True)
+                                subprocess.run(['s3cmd', 'get', full_file_path, destination_dir, '-c', S3_CONFIG], check=True)
                                 print(f"Downloaded: {full_file_path} to {destination_dir}")
                             except subprocess.CalledProcessError as e:
                                 # File does not exist, log the missing file
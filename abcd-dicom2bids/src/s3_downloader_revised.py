@@ -1,12 +1,18 @@
 #! /usr/bin/env python3
 
 
+import numpy as np
 import pandas as pd
 import csv
 import subprocess
 import os
 import sys
 import argparse
+from collections import defaultdict, deque
+from contextlib import closing
+from concurrent.futures import ThreadPoolExecutor
+import queue
+import threading
 
 #######################################
 # Read in ABCD_good_and_bad_series_table.csv (renamed to ABCD_operator_QC.csv) that is continually updated
@@ -24,6 +30,15 @@ TMP_DIR = os.path.join(os.path.dirname(os.path.dirname(
                     os.path.abspath(__file__))), "temp") 
 YEARS = ['baseline_year_1_arm_1', '2_year_follow_up_y_arm_1',  '00A', '02A', '04A', '06A', '08A']
 MODALITIES = ['anat', 'func', 'dwi']
+FUNC_TASK_SERIES_TYPES = ('ABCD-rsfMRI', 'ABCD-MID-fMRI', 'ABCD-nBack-fMRI', 'ABCD-SST-fMRI')
+LOG_COLUMNS = ('t1', 't2', 'sefm', 'rsfmri', 'mid', 'sst', 'nback', 'dti')  # After subject and session
+PARTIAL_DOWNLOAD_SUFFIX = '.part'  # Added to files until they finish downloading
+MAX_PENDING_SUB_VISITS = 64  # Subject visits to check ahead of logging them
+DOWNLOAD_QUEUE_SIZE = 1024  # Files to download that can wait in the queue at once
+LOG_BATCH_SIZE = 256  # Subject visits to write to the download log at once
+QC_CSV_DTYPES = {'pGUID': 'category', 'EventName': 'category',
+                 'SeriesType': 'category', 'usable': 'float32',
+                 'filename': 'string'}
 
 def generate_parser(parser=None):
 
@@ -79,6 +94,14 @@ def generate_parser(parser=None):
         dest='s3_config',
         help="config file with S3 Bucket Credentials"
 )
+    parser.add_argument(
+        '-j',
+        '--jobs',
+        dest='jobs',
+        type=int,
+        default=32,
+        help="Number of files to download from the S3 bucket at once. Default: 32"
+)
 
     return parser
 
@@ -96,13 +119,14 @@ def main(argv=sys.argv):
     num_t2 = 0
     num_dti = 0
 
+    # Every download and missing file tuple queued below, to skip duplicates
+    listed_files = set()
 
     series_csv = args.qc_csv
     if args.subject_list:
-        f = open(args.subject_list, 'r')
-        x = f.readlines()
-        f.close
-        subject_list = [sub.strip() for sub in x]
+        # Read the subject IDs line by line, skipping blank lines
+        with open(args.subject_list, 'r') as f:
+            subject_list = [line.strip() for line in f if line.strip()]
         log = os.path.join(os.path.dirname(args.subject_list), os.path.splitext(os.path.basename(args.subject_list))[0] + "_download_log.csv")
     year_list = args.year_list
     if isinstance(year_list, str):
@@ -111,6 +135,10 @@ def main(argv=sys.argv):
     if isinstance(modalities, str):
         modalities = modalities.split(',')
     download_dir = args.download_dir
+    path_adders = get_path_adders(modalities)
+    # Add the BIDS prefixes to the subject and session IDs once, up front
+    bids_ids = ['sub-' + sub for sub in subject_list]
+    ses_names = [(bids_year, 'ses-' + bids_year) for bids_year in year_list]
 
     print("s3_downloader.py command line arguments:")    
     print("     QC spreadsheet      : {}".format(series_csv))
@@ -118,122 +146,115 @@ def main(argv=sys.argv):
     print("     Year                : {}".format(year_list))
     print("     Modalities          : {}".format(modalities))
 
-    with open(log, 'w') as f:
-        writer = csv.writer(f)
-
-        # Read csv as pandas dataframe, drop duplicate entries, sort, and group by subject/visit
-        series_header = pd.read_csv(series_csv, nrows=0).columns.tolist()
-        series_df = pd.read_csv(series_csv, usecols=list(range(0,len(series_header))))
-
-        # If subject list is provided
-        # Get list of all unique subjects if not provided
-        # subject_list = series_df.pGUID.unique()
-        # year_list = ['baseline_year_1_arm_1']
-        # Get list of all years if not provided
-        # year_list = series_df.EventName.unique()
-        uid_start = "INV"
-        for sub in subject_list:
-            # uid = sub.split(uid_start, 1)[1]
-            # pguid = 'NDAR_INV' + ''.join(sub)
-            bids_id = 'sub-' + ''.join(sub)
-            subject_df = series_df[series_df['pGUID'] == bids_id]
-            for bids_year in year_list:
-                year = 'ses-' + ''.join(bids_year)
-                sub_ses_df = subject_df[subject_df['EventName'] == year]
-                sub_pass_QC_df = sub_ses_df[sub_ses_df['usable'] != 0.0] #changed this line back to be able to filter based on QC from fast track
-                file_paths = []
-                ### Logging information
-                # initialize logging variables
-                has_t1 = 0
-                has_t2 = 0
-                has_sefm = 0
-                has_rsfmri = 0
-                has_mid = 0
-                has_sst = 0
-                has_nback = 0
-                has_dti = 0
-
-                num_sub_visits += 1
-                tgz_dir = os.path.join(download_dir, bids_id, f'ses-{bids_year}')
-                print("Checking QC data for valid images for {} {}.".format(bids_id, year))
-                os.makedirs(tgz_dir, exist_ok=True)
-                                
-                if 'anat' in modalities:
-                    (file_paths, has_t1, has_t2) = add_anat_paths(sub_pass_QC_df, file_paths)
-                if 'func' in modalities:
-                    (file_paths, has_sefm, has_rsfmri, has_mid, has_sst, has_nback) = add_func_paths(sub_ses_df, sub_pass_QC_df, file_paths)
-                if 'dwi' in modalities:
-                    (file_paths, has_dti) = add_dwi_paths(sub_ses_df, sub_pass_QC_df, file_paths)
-                    
-            
-        
-                # TODO: log subject level information
-                print(' t1=%s, t2=%s, sefm=%s, rsfmri=%s, mid=%s, sst=%s, nback=%s, has_dti=%s' % (has_t1, has_t2, has_sefm, has_rsfmri, has_mid, has_sst, has_nback, has_dti))
-                writer.writerow([bids_id, year, has_t1, has_t2, has_sefm, has_rsfmri, has_mid, has_sst, has_nback, has_dti])
+    missing_files_log = os.path.join(TMP_DIR,'missing_files_test.txt')
+    # Create the log file if it doesn't exist
+    if not os.path.exists(missing_files_log):
+        with open(missing_files_log, 'w') as log_file:
+            log_file.write("Missing files log:\n")
+        os.chmod(missing_files_log, 0o664)
+
+    # Download files while the subject visits are still being checked. This
+    # thread puts each file to download on download_queue, which only holds
+    # DOWNLOAD_QUEUE_SIZE files, so checking waits whenever downloads fall
+    # behind. args.jobs threads download the files, since each download mostly
+    # waits on S3, and one more thread logs the files that they could not get.
+    # They are daemon threads so that a second Ctrl-C can still exit while
+    # this thread waits for them.
+    download_queue = queue.Queue(maxsize=DOWNLOAD_QUEUE_SIZE)
+    results_queue = queue.Queue()
+    downloaders = [threading.Thread(target=download_queued_files, args=(download_queue, results_queue, args.s3_config), daemon=True)
+                   for _ in range(args.jobs)]
+    missing_files_writer = threading.Thread(target=write_missing_files, args=(results_queue, missing_files_log), daemon=True)
+    for thread in downloaders + [missing_files_writer]:
+        thread.start()
+
+    try:
+        # Buffer the download log so its rows are written in large batches
+        with open(log, 'w', buffering=1 << 20) as f:
+            writer = csv.writer(f)
+
+            # Read csv as pandas dataframe, drop duplicate entries, sort, and group by subject/visit
+            # Only read the columns used below, storing the repeated IDs and
+            # SeriesTypes as categoricals
+            series_df = pd.read_csv(series_csv, usecols=QC_CSV_DTYPES.keys(),
+                                    dtype=QC_CSV_DTYPES, engine='c')
+            # Drop the rows of subjects not in the subject list up front so that
+            # every later step only works on the rows it can use
+            series_df = series_df[series_df['pGUID'].isin(bids_ids)].copy()
+            series_df['pGUID'] = series_df['pGUID'].cat.remove_unused_categories()
+
+            # If subject list is provided
+            # Get list of all unique subjects if not provided
+            # subject_list = series_df.pGUID.unique()
+            # year_list = ['baseline_year_1_arm_1']
+            # Get list of all years if not provided
+            # year_list = series_df.EventName.unique()
+            uid_start = "INV"
+            # Find each subject visit's files to download in a thread pool, then
+            # log the visits in subject list order from this thread
+            log_rows = []
+            with closing(process_sub_visits(iter_sub_visits(series_df, bids_ids, ses_names), path_adders, download_dir, args.s3_bucket, args.s3_config)) as sub_visit_results:
+                for (sub_visit, (log_row, sub_visit_downloads, sub_visit_missing)) in sub_visit_results:
+                    (bids_id, year, has_t1, has_t2, has_sefm, has_rsfmri, has_mid, has_sst, has_nback, has_dti) = log_row
+                    num_sub_visits += 1
+                    print("Checking QC data for valid images for {} {}.".format(bids_id, year))
+
+                    # TODO: log subject level information
+                    print(' t1=%s, t2=%s, sefm=%s, rsfmri=%s, mid=%s, sst=%s, nback=%s, has_dti=%s' % (has_t1, has_t2, has_sefm, has_rsfmri, has_mid, has_sst, has_nback, has_dti))
+                    log_rows.append(log_row)
+                    if len(log_rows) == LOG_BATCH_SIZE:
+                        writer.writerows(log_rows)
+                        f.flush()
+                        log_rows.clear()
                 
-                if has_t1 != 0:
-                    num_t1 += 1
-                if has_t2 != 0:
-                    num_t2 += 1
-                if has_rsfmri != 0 and has_rsfmri != 10000:
-                    num_rsfmri += 1
-                if has_mid != 0 and has_mid != 10000:
-                    num_mid += 1
-                if has_sst != 0 and has_sst != 10000:
-                    num_sst += 1
-                if has_nback != 0 and has_nback != 10000:
-                    num_nback += 1
-                if has_dti != 0:
-                    num_dti += 1
+                    if has_t1 != 0:
+                        num_t1 += 1
+                    if has_t2 != 0:
+                        num_t2 += 1
+                    if has_rsfmri != 0 and has_rsfmri != 10000:
+                        num_rsfmri += 1
+                    if has_mid != 0 and has_mid != 10000:
+                        num_mid += 1
+                    if has_sst != 0 and has_sst != 10000:
+                        num_sst += 1
+                    if has_nback != 0 and has_nback != 10000:
+                        num_nback += 1
+                    if has_dti != 0:
+                        num_dti += 1
+
+                    # Only download or log each file once, even if more than one
+                    # QC row lists it
+                    new_downloads = []
+                    for download in sub_visit_downloads:
+                        if download not in listed_files:
+                            listed_files.add(download)
+                            new_downloads.append(download)
+                    missing_lines = []
+                    for missing_file in sub_visit_missing:
+                        if missing_file not in listed_files:
+                            listed_files.add(missing_file)
+                            (bids_id, bids_year, full_file_path) = missing_file
+                            missing_lines.append(f"{bids_id}; {bids_year}; {full_file_path}\n")
+
+                    # Tell the missing files writer how many downloads to wait for
+                    # before logging the visit's missing files, then queue them
+                    results_queue.put((sub_visit, len(new_downloads), missing_lines))
+                    for download in new_downloads:
+                        download_queue.put(download)
+                writer.writerows(log_rows)
+    finally:
+        # Let the threads finish the queued downloads and logging, then stop.
+        # Stop the missing files writer even if waiting on the downloads is
+        # interrupted, so it still logs the missing files found so far
+        try:
+            for _ in downloaders:
+                download_queue.put(None)
+            for thread in downloaders:
+                thread.join()
+        finally:
+            results_queue.put(None)
+            missing_files_writer.join()
 
-                
-                missing_files_log = os.path.join(TMP_DIR,'missing_files_test.txt')
-                # Create the log file if it doesn't exist
-                if not os.path.exists(missing_files_log):
-                    with open(missing_files_log, 'w') as log_file:
-                        log_file.write("Missing files log:\n")
-                    os.chmod(missing_files_log, 0o664)
-                
-                for file_path in file_paths:
-                    #ensure file_path is string type
-                    file_path = str(file_path)
-                    # Split the file_path by ';' and process each value
-                    for split_value in file_path.split(';'):
-                        # full_file_path = f"{args.s3_bucket}/{bids_id}/ses-{bids_year}/{split_value.strip()}"
-                        full_file_path = f"{args.s3_bucket}/{split_value.strip()}"
-                        print("Trying to Download",full_file_path)
-                        # Check if the file exists in the S3 bucket
-                        result = subprocess.run(['s3cmd', 'ls', full_file_path, '-c', args.s3_config], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-                        print(result.stdout.decode())
-                        print(result.stderr.decode())
-                        print(result.returncode)
-
-                        if result.returncode == 0:
-                            # Extract the second last directory (e.g., "anat" from the full path)
-                            second_last_dir = full_file_path.split('/')[-2]
-                            file_name = full_file_path.split('/')[-1]
-                            
-                            # Construct the destination directory
-                            destination_dir = os.path.join(tgz_dir, second_last_dir,file_name)
-                            # os.makedirs(destination_dir, exist_ok=True)  # Create the destination directory if it doesn't exist
-                            try:
-                                subprocess.run(['s3cmd', 'get', full_file_path, destination_dir, '-c', args.s3_config], check=True)
-                                print(f"Downloaded: {full_file_path} to {destination_dir}")
-                            except subprocess.CalledProcessError as e:
-                                # File does not exist, log the missing file
-                                with open(missing_files_log, 'a') as log_file:
-                                    log_file.write(f"{bids_id}; {bids_year}; {full_file_path}\n")
-                                print(f"Missing: {full_file_path}")
-                                print(f"Error syncing {full_file_path} to {destination_dir}: {e}")
-                        else:
-                            # File does not exist, log the missing file
-                            try:
-                                with open(missing_files_log, 'a') as log_file:
-                                    log_file.write(f"{bids_id}; {bids_year}; {full_file_path}; \n")
-                            except OSError as e:
-                                print(f"Error writing to log file: {e}")
-
-                
     print("There are %s subject visits" % num_sub_visits)
     print("number of subjects with a T1 : %s" % num_t1)
     print("number of subjects with a T2 : %s" % num_t2)
@@ -244,106 +265,375 @@ def main(argv=sys.argv):
     print("number of subjects with dti  : %s" % num_dti)
 
 
-def add_anat_paths(passed_QC_group, file_paths):
+def iter_sub_visits(series_df, bids_ids, ses_names):
+    """
+    Get the QC rows of each subject visit, one subject visit at a time
+    :param series_df: pandas.DataFrame with the QC rows of every subject
+    :param bids_ids: List of subject IDs starting with 'sub-'
+    :param ses_names: List of (session name without 'ses-', session name with
+                      'ses-') tuples
+    :return: Generator of (bids_id, bids_year, year, sub_ses_df) tuples, where
+             sub_ses_df has no rows if the QC data has none for that visit
+    """
+    # Group the rows by subject/visit once instead of scanning the whole
+    # dataframe for every subject and year
+    sub_ses_groups = series_df.groupby(['pGUID', 'EventName'], sort=False, observed=True)
+    for bids_id in bids_ids:
+        # uid = sub.split(uid_start, 1)[1]
+        # pguid = 'NDAR_INV' + ''.join(sub)
+        for (bids_year, year) in ses_names:
+            try:
+                sub_ses_df = sub_ses_groups.get_group((bids_id, year))
+            except KeyError:
+                sub_ses_df = series_df.iloc[:0]
+            yield (bids_id, bids_year, year, sub_ses_df)
+
+
+def process_sub_visits(sub_visits, *process_args):
+    """
+    Run process_sub_visit on each subject visit in a thread pool, submitting
+    at most MAX_PENDING_SUB_VISITS of them before reading their results
+    :param sub_visits: Iterable of (bids_id, bids_year, year, sub_ses_df)
+                       tuples from iter_sub_visits
+    :param process_args: The rest of the arguments to process_sub_visit
+    :return: Generator of ((bids_id, bids_year), process_sub_visit result)
+             tuples, in the same order as sub_visits
+    """
+    pending = deque()
+    with ThreadPoolExecutor() as executor:
+        try:
+            for (bids_id, bids_year, year, sub_ses_df) in sub_visits:
+                pending.append(((bids_id, bids_year), executor.submit(process_sub_visit, bids_id, bids_year, year, sub_ses_df, *process_args)))
+                if len(pending) >= MAX_PENDING_SUB_VISITS:
+                    (sub_visit, future) = pending.popleft()
+                    yield (sub_visit, future.result())
+            while pending:
+                (sub_visit, future) = pending.popleft()
+                yield (sub_visit, future.result())
+        finally:
+            # After an error, only wait for the subject visits already running
+            for (_, future) in pending:
+                future.cancel()
+
+
+def get_path_adders(modalities):
+    """
+    Pick the functions adding each requested modality's file paths once,
+    instead of checking which modalities to download for every subject visit
+    :param modalities: List of the modalities to download
+    :return: List of (function, log columns) pairs. Each function takes a
+             subject visit's rows and its rows that pass QC, both from
+             group_by_series_type, and the list of file paths to add to, and
+             returns that list and a count for each of its log columns
+    """
+    path_adders = []
+    if 'anat' in modalities:
+        path_adders.append((add_anat_paths, ('t1', 't2')))
+    if 'func' in modalities:
+        path_adders.append((add_func_paths, ('sefm', 'rsfmri', 'mid', 'sst', 'nback')))
+    if 'dwi' in modalities:
+        path_adders.append((add_dwi_paths, ('dti',)))
+    return path_adders
+
+
+def process_sub_visit(bids_id, bids_year, year, sub_ses_df, path_adders, download_dir, s3_bucket, s3_config):
+    """
+    Find which files of one subject visit pass QC and should be downloaded
+    :param bids_id: String, subject ID starting with 'sub-'
+    :param bids_year: String, session name without its 'ses-' prefix
+    :param year: String, session name with its 'ses-' prefix
+    :param sub_ses_df: pandas.DataFrame with all QC rows of the subject visit
+    :param path_adders: List of (function, log columns) pairs from
+                        get_path_adders for the modalities to download
+    :param download_dir: String, path to download the subjects to
+    :param s3_bucket: String, path of the S3 bucket to download from
+    :param s3_config: String, path to s3cmd config file with S3 credentials
+    :return: Tuple of the subject visit's row for the download log, a list of
+             (bids_id, bids_year, S3 path, destination) for each file to
+             download, and a list of (bids_id, bids_year, S3 path) for each
+             file missing from the S3 bucket
+    """
+    # The subject visit only has a few rows, so work on plain numpy arrays of
+    # the columns used instead of paying pandas' overhead on every selection
+    # (SeriesType as its integer categorical codes, which are faster to compare)
+    series_types = sub_ses_df['SeriesType'].cat.categories
+    sub_ses_rows = {col: sub_ses_df[col].to_numpy() for col in ('usable', 'filename')}
+    sub_ses_rows['SeriesType'] = sub_ses_df['SeriesType'].cat.codes.to_numpy()
+    sub_pass_QC_rows = select_rows(sub_ses_rows, sub_ses_rows['usable'] != 0.0) #changed this line back to be able to filter based on QC from fast track
+    # Split the rows by SeriesType once for all of the path functions below
+    sub_ses_types = group_by_series_type(sub_ses_rows, series_types)
+    sub_pass_QC_types = group_by_series_type(sub_pass_QC_rows, series_types)
+    file_paths = []
+    ### Logging information
+    # initialize logging variables
+    has = dict.fromkeys(LOG_COLUMNS, 0)
+
+    tgz_dir = os.path.join(download_dir, bids_id, year)
+    os.makedirs(tgz_dir, exist_ok=True)
+
+    for (add_paths, log_columns) in path_adders:
+        (file_paths, *counts) = add_paths(sub_ses_types, sub_pass_QC_types, file_paths)
+        has.update(zip(log_columns, counts))
+
+    full_file_paths = []
+    for file_path in file_paths:
+        #ensure file_path is string type
+        file_path = str(file_path)
+        # Split the file_path by ';' and queue each value for download
+        for split_value in file_path.split(';'):
+            # full_file_path = f"{s3_bucket}/{bids_id}/ses-{bids_year}/{split_value.strip()}"
+            full_file_paths.append(f"{s3_bucket}/{split_value.strip()}")
+
+    # List all of the subject visit's files in the S3 bucket at once, so files
+    # missing from it are logged without trying to download each of them, but
+    # only if any of the files to download are under the subject visit's path
+    s3_prefix = f"{s3_bucket}/{bids_id}/{year}/"
+    s3_files = None
+    if any(full_file_path.startswith(s3_prefix) for full_file_path in full_file_paths):
+        s3_files = list_s3_files(s3_prefix, s3_config)
+
+    downloads = []
+    missing = []
+    for full_file_path in full_file_paths:
+        if s3_files is not None and full_file_path.startswith(s3_prefix) and full_file_path not in s3_files:
+            missing.append((bids_id, bids_year, full_file_path))
+            continue
+        # Extract the second last directory (e.g., "anat" from the full path) and file name
+        (_, second_last_dir, file_name) = full_file_path.rsplit('/', 2)
+
+        # Construct the destination directory
+        destination_dir = os.path.join(tgz_dir, second_last_dir,file_name)
+        downloads.append((bids_id, bids_year, full_file_path, destination_dir))
+
+    return ([bids_id, year, *has.values()], downloads, missing)
+
+
+def list_s3_files(s3_prefix, s3_config):
+    """
+    List every file under a path in the S3 bucket with one s3cmd ls call
+    :param s3_prefix: String, s3:// path of the directory to list
+    :param s3_config: String, path to s3cmd config file with S3 credentials
+    :return: Set of the s3:// paths of the files under s3_prefix, or None if
+             they could not be listed
+    """
+    result = subprocess.run(['s3cmd', 'ls', '--recursive', s3_prefix, '-c', s3_config], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if result.returncode != 0:
+        return None
+    # Each line is the date, time, size, and then the s3:// path of a file
+    s3_files = set()
+    for line in result.stdout.decode().splitlines():
+        fields = line.split(None, 3)
+        if len(fields) == 4:
+            s3_files.add(fields[3])
+    return s3_files
+
+
+def download_queued_files(download_queue, results_queue, s3_config):
+    """
+    Download each file put on download_queue until it gets None
+    :param download_queue: queue.Queue of (bids_id, bids_year, S3 path,
+                           destination) tuples of the files to download
+    :param results_queue: queue.Queue to put a (subject visit, -1, missing
+                          files log lines) tuple on after each download
+    :param s3_config: String, path to s3cmd config file with S3 credentials
+    """
+    for (bids_id, bids_year, full_file_path, destination_dir) in iter(download_queue.get, None):
+        # Keep downloading after an unexpected error, so the queue never stops
+        # being emptied, and count the file as missing
+        try:
+            downloaded = download_s3_file(full_file_path, destination_dir, s3_config)
+        except Exception as e:
+            print(f"Error downloading {full_file_path} to {destination_dir}: {e}")
+            downloaded = False
+        if downloaded:
+            missing_lines = []
+        else:
+            # File does not exist, log the missing file
+            missing_lines = [f"{bids_id}; {bids_year}; {full_file_path}\n"]
+        results_queue.put(((bids_id, bids_year), -1, missing_lines))
+
+
+def write_missing_files(results_queue, missing_files_log):
+    """
+    Write each subject visit's missing files to the missing files log at once,
+    after the last of its downloads finishes, until results_queue gets None
+    :param results_queue: queue.Queue of (subject visit, change in the number
+                          of its downloads left, missing files log lines)
+                          tuples. Each subject visit's first tuple adds all of
+                          its downloads, and each finished download takes one
+    :param missing_files_log: String, path to the missing files log
+    """
+    downloads_left = defaultdict(int)
+    missing_files = defaultdict(list)
+    with open(missing_files_log, 'a') as log_file:
+        for (sub_visit, downloads_added, missing_lines) in iter(results_queue.get, None):
+            downloads_left[sub_visit] += downloads_added
+            missing_files[sub_visit] += missing_lines
+            if not downloads_left[sub_visit]:
+                del downloads_left[sub_visit]
+                log_file.writelines(missing_files.pop(sub_visit))
+
+
+def download_s3_file(full_file_path, destination_dir, s3_config):
+    """
+    Download one file from the S3 bucket with s3cmd
+    :param full_file_path: String, s3:// path of the file to download
+    :param destination_dir: String, local path to download the file to
+    :param s3_config: String, path to s3cmd config file with S3 credentials
+    :return: True if the file was downloaded and False if it is missing
+    """
+    # Skip files already downloaded by an earlier run
+    if os.path.exists(destination_dir):
+        print(f"Already downloaded: {full_file_path} to {destination_dir}")
+        return True
+    print("Trying to Download",full_file_path)
+    # Download to a temporary name and only rename the file once it is
+    # complete, so a download cut off by a crash is not taken as finished
+    partial_download = destination_dir + PARTIAL_DOWNLOAD_SUFFIX
+    result = subprocess.run(['s3cmd', 'get', '--force', full_file_path, partial_download, '-c', s3_config], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if result.returncode == 0:
+        os.replace(partial_download, destination_dir)
+        print(f"Downloaded: {full_file_path} to {destination_dir}")
+        return True
+    print(f"Missing: {full_file_path}")
+    print(f"Error syncing {full_file_path} to {destination_dir}: {result.stderr.decode().strip()}")
+    return False
+
+
+def select_rows(rows, index):
+    """
+    :param rows: Dictionary mapping each QC column name to a numpy array
+    :param index: Slice, boolean mask, or integer indices of the rows to keep
+    :return: Dictionary mapping each QC column name to the kept rows' values
+    """
+    return {col: values[index] for col, values in rows.items()}
+
+
+def concat_rows(first_rows, second_rows):
+    """
+    :param first_rows: Dictionary mapping each QC column name to a numpy array
+    :param second_rows: Dictionary with the same columns as first_rows
+    :return: Dictionary mapping each QC column name to the values of
+             first_rows followed by the values of second_rows
+    """
+    return {col: np.concatenate((values, second_rows[col]))
+            for col, values in first_rows.items()}
+
+
+def count_rows(rows):
+    """
+    :param rows: Dictionary mapping each QC column name to a numpy array
+    :return: Integer, the number of rows
+    """
+    return len(rows['filename'])
+
+
+def group_by_series_type(group, series_types):
+    """
+    Split a subject visit's QC rows by SeriesType once, so each SeriesType's
+    rows can be looked up instead of found by scanning the whole group
+    :param group: Dictionary mapping each QC column name to a numpy array
+                  with its values for one subject visit, with the integer
+                  categorical codes of each row's SeriesType as 'SeriesType'
+    :param series_types: pandas.Index of the SeriesType categories
+    :return: defaultdict mapping each SeriesType to its rows in group, or to
+             no rows if group has no rows of that SeriesType
+    """
+    codes = group['SeriesType']
+    by_type = defaultdict(lambda: select_rows(group, slice(0)))
+    for code in np.unique(codes[codes >= 0]):
+        by_type[series_types[code]] = select_rows(group, np.flatnonzero(codes == code))
+    return by_type
+
+
+def add_anat_paths(all_types, passed_QC_types, file_paths):
     ##  If T1_NORM exists, only download that file instead of normal T1
-    T1_df = passed_QC_group[passed_QC_group['SeriesType'] == 'ABCD-T1-NORM']
-    if T1_df.empty:
-        T1_df = passed_QC_group[passed_QC_group['SeriesType'] == 'ABCD-T1']
-        if T1_df.empty:
+    T1_rows = passed_QC_types['ABCD-T1-NORM']
+    if not count_rows(T1_rows):
+        T1_rows = passed_QC_types['ABCD-T1']
+        if not count_rows(T1_rows):
             has_t1 = 0 # No T1s. Invalid subject
         else:
-            for file_path in T1_df['filename']:
-                file_paths += [file_path]
-            has_t1 = T1_df.shape[0]
+            file_paths.extend(T1_rows['filename'].tolist())
+            has_t1 = count_rows(T1_rows)
     else:
-        for file_path in T1_df["filename"]:
-            file_paths += [file_path]
-        has_t1 = T1_df.shape[0]
+        file_paths.extend(T1_rows['filename'].tolist())
+        has_t1 = count_rows(T1_rows)
 
     ##  If T2_NORM exists, only download that file instead of normal T2
-    T2_df = passed_QC_group[passed_QC_group['SeriesType'] == 'ABCD-T2-NORM']
-    if T2_df.empty:
-        T2_df = passed_QC_group[passed_QC_group['SeriesType'] == 'ABCD-T2']
-        if T2_df.empty:
+    T2_rows = passed_QC_types['ABCD-T2-NORM']
+    if not count_rows(T2_rows):
+        T2_rows = passed_QC_types['ABCD-T2']
+        if not count_rows(T2_rows):
             has_t2 = 0 # No T1s. Invalid subject
         else:
-            for file_path in T2_df['filename']:
-                file_paths += [file_path]
-            has_t2 = T2_df.shape[0]
+            file_paths.extend(T2_rows['filename'].tolist())
+            has_t2 = count_rows(T2_rows)
     else:
-        for file_path in T2_df["filename"]:
-            file_paths += [file_path]
-        has_t2 = T2_df.shape[0]
+        file_paths.extend(T2_rows['filename'].tolist())
+        has_t2 = count_rows(T2_rows)
 
     return (file_paths, has_t1, has_t2)
 
-def add_func_paths(all_group,passed_QC_group, file_paths):
+def add_func_paths(all_types, passed_QC_types, file_paths):
     #convert func files only if any one task or rest func file exists
-    if passed_QC_group['SeriesType'].isin(['ABCD-rsfMRI', 'ABCD-MID-fMRI', 'ABCD-nBack-fMRI', 'ABCD-SST-fMRI']).any():
+    if any(count_rows(passed_QC_types[series_type]) for series_type in FUNC_TASK_SERIES_TYPES):
 
         ## Pair SEFMs and only download if both pass QC
         #   Check first if just the FM exists
-        FM_df = passed_QC_group[passed_QC_group['SeriesType'] == 'ABCD-fMRI-FM']
-        if FM_df.empty:
-            ## Pair SEFMs first based on all fmaps available using the all_group def i.e. sub_ses_df before filtering for QC
-            FM_AP_df = all_group[all_group['SeriesType'] == 'ABCD-fMRI-FM-AP']
-            FM_PA_df = all_group[all_group['SeriesType'] == 'ABCD-fMRI-FM-PA']
-            # if FM_AP_df.shape[0] != FM_PA_df.shape[0] or FM_AP_df.empty:
-            if FM_AP_df.empty:
+        FM_rows = passed_QC_types['ABCD-fMRI-FM']
+        if not count_rows(FM_rows):
+            ## Pair SEFMs first based on all fmaps available using the all_types def i.e. sub_ses_types before filtering for QC
+            FM_AP_rows = all_types['ABCD-fMRI-FM-AP']
+            FM_PA_rows = all_types['ABCD-fMRI-FM-PA']
+            # if count_rows(FM_AP_rows) != count_rows(FM_PA_rows) or not count_rows(FM_AP_rows):
+            if not count_rows(FM_AP_rows):
                 has_sefm = 0 # No SEFMs. Invalid subject
             else:
-                # If there are a different number of AP and PA fmaps, then figure out which has fewer to use for upper_range value to iterate through
-                if FM_AP_df.shape[0] <= FM_PA_df.shape[0]:
-                    upper_range=FM_AP_df.shape[0]
-                elif FM_AP_df.shape[0] > FM_PA_df.shape[0]:
-                    upper_range=FM_PA_df.shape[0]
-
-                #for i in range(0, FM_AP_df.shape[0]):
-                for i in range(0, upper_range):
-                    if FM_AP_df.iloc[i]['usable'] != 0.0 and FM_PA_df.iloc[i]['usable'] != 0.0:
-                        FM_df = FM_df.append(FM_AP_df.iloc[i])
-                        FM_df = FM_df.append(FM_PA_df.iloc[i])
-        if FM_df.empty:
+                # If there are a different number of AP and PA fmaps, then only pair up as many as there are of whichever has fewer
+                upper_range = min(count_rows(FM_AP_rows), count_rows(FM_PA_rows))
+                FM_AP_rows = select_rows(FM_AP_rows, slice(upper_range))
+                FM_PA_rows = select_rows(FM_PA_rows, slice(upper_range))
+
+                # Keep each AP/PA pair only if both of its fmaps pass QC
+                pair_usable = (FM_AP_rows['usable'] != 0.0) & (FM_PA_rows['usable'] != 0.0)
+                FM_rows = concat_rows(select_rows(FM_AP_rows, pair_usable), select_rows(FM_PA_rows, pair_usable))
+        if not count_rows(FM_rows):
             has_sefm = 0 # No SEFMs. Invalid subject
             return (file_paths, has_sefm, 10000 , 10000, 10000, 10000)########### added to not download any func even if qc==1, if they dont have any pair of fmap i.e. has_sefm=0
         else:
-            for file_path in FM_df['filename']:
-                file_paths += [file_path]
-            has_sefm = FM_df.shape[0]
+            file_paths.extend(FM_rows['filename'].tolist())
+            has_sefm = count_rows(FM_rows)
 
 
         ## List all rsfMRI scans that pass QC
-        RS_df = passed_QC_group.loc[passed_QC_group['SeriesType'] == 'ABCD-rsfMRI']
-        if RS_df.empty:
+        RS_rows = passed_QC_types['ABCD-rsfMRI']
+        if not count_rows(RS_rows):
             has_rsfmri = 0
         else:
-            for file_path in RS_df['filename']:
-                file_paths += [file_path]
-            has_rsfmri = RS_df.shape[0]
+            file_paths.extend(RS_rows['filename'].tolist())
+            has_rsfmri = count_rows(RS_rows)
 
         ## List only download task if and only if there is a pair of scans for the task that passed QC
-        MID_df = passed_QC_group.loc[passed_QC_group['SeriesType'] == 'ABCD-MID-fMRI']
+        MID_rows = passed_QC_types['ABCD-MID-fMRI']
 
-        if MID_df.empty:
+        if not count_rows(MID_rows):
             has_mid = 0
         else:
-            for file_path in MID_df['filename']:
-                file_paths += [file_path]
-            has_mid = MID_df.shape[0]
-        SST_df = passed_QC_group.loc[passed_QC_group['SeriesType'] == 'ABCD-SST-fMRI']
-        if SST_df.empty:
+            file_paths.extend(MID_rows['filename'].tolist())
+            has_mid = count_rows(MID_rows)
+        SST_rows = passed_QC_types['ABCD-SST-fMRI']
+        if not count_rows(SST_rows):
             has_sst = 0
         else:
-            for file_path in SST_df['filename']:
-                file_paths += [file_path]
-            has_sst = SST_df.shape[0]
-        nBack_df = passed_QC_group.loc[passed_QC_group['SeriesType'] == 'ABCD-nBack-fMRI']
-        if nBack_df.empty:
+            file_paths.extend(SST_rows['filename'].tolist())
+            has_sst = count_rows(SST_rows)
+        nBack_rows = passed_QC_types['ABCD-nBack-fMRI']
+        if not count_rows(nBack_rows):
             has_nback = 0
         else:
-            for file_path in nBack_df['filename']:
-                file_paths += [file_path]
-            has_nback = nBack_df.shape[0]
+            file_paths.extend(nBack_rows['filename'].tolist())
+            has_nback = count_rows(nBack_rows)
 
 
         return (file_paths, has_sefm, has_rsfmri, has_mid, has_sst, has_nback)
@@ -351,39 +641,34 @@ def add_func_paths(all_group,passed_QC_group, file_paths):
         return(file_paths, 0, 0, 0, 0, 0)
 
 
-def add_dwi_paths(all_group, passed_QC_group, file_paths):
-    DTI_df = passed_QC_group.loc[passed_QC_group['SeriesType'] == 'ABCD-DTI']
-    if DTI_df.shape[0] >= 1:
+def add_dwi_paths(all_types, passed_QC_types, file_paths):
+    DTI_rows = passed_QC_types['ABCD-DTI']
+    if count_rows(DTI_rows) >= 1:
         # If a DTI exists then download all passing DTI fieldmaps
-        DTI_FM_df = passed_QC_group.loc[passed_QC_group['SeriesType'] == 'ABCD-Diffusion-FM']
+        DTI_FM_rows = passed_QC_types['ABCD-Diffusion-FM']
         # If not present, next search and sort AP/PA fmaps
-        if DTI_FM_df.empty:
-            DTI_FM_AP_df = all_group[all_group['SeriesType'] == 'ABCD-Diffusion-FM-AP']
-            DTI_FM_PA_df = all_group[all_group['SeriesType'] == 'ABCD-Diffusion-FM-PA']
-            DTI_FM_df = pd.DataFrame()
+        if not count_rows(DTI_FM_rows):
+            DTI_FM_AP_rows = all_types['ABCD-Diffusion-FM-AP']
+            DTI_FM_PA_rows = all_types['ABCD-Diffusion-FM-PA']
             
-            # if DTI_FM_AP_df.shape[0] != DTI_FM_PA_df.shape[0] or DTI_FM_AP_df.empty:
-            if DTI_FM_AP_df.empty:
+            # if count_rows(DTI_FM_AP_rows) != count_rows(DTI_FM_PA_rows) or not count_rows(DTI_FM_AP_rows):
+            if not count_rows(DTI_FM_AP_rows):
                 return (file_paths, 0)
             else:
-                # If there are a different number of AP and PA fmaps, then figure out which has fewer to use for upper_range value to iterate through
-                if DTI_FM_AP_df.shape[0] <= DTI_FM_PA_df.shape[0]:
-                    upper_range=DTI_FM_AP_df.shape[0]
-                elif DTI_FM_AP_df.shape[0] > DTI_FM_PA_df.shape[0]:
-                    upper_range=DTI_FM_PA_df.shape[0]
-                
-                for i in range(0, upper_range):
-                    if DTI_FM_AP_df.iloc[i]['usable'] != 0.0 and DTI_FM_PA_df.iloc[i]['usable'] != 0.0:
-                        DTI_FM_df = DTI_FM_df.append(DTI_FM_AP_df.iloc[i])
-                        DTI_FM_df = DTI_FM_df.append(DTI_FM_PA_df.iloc[i])
-        if not DTI_FM_df.empty:
-            for file_path in DTI_df['filename']:
-                file_paths += [file_path]
-            for file_path in DTI_FM_df['filename']:
-                file_paths += [file_path]
-        has_dti = DTI_df.shape[0]
+                # If there are a different number of AP and PA fmaps, then only pair up as many as there are of whichever has fewer
+                upper_range = min(count_rows(DTI_FM_AP_rows), count_rows(DTI_FM_PA_rows))
+                DTI_FM_AP_rows = select_rows(DTI_FM_AP_rows, slice(upper_range))
+                DTI_FM_PA_rows = select_rows(DTI_FM_PA_rows, slice(upper_range))
+
+                # Keep each AP/PA pair only if both of its fmaps pass QC
+                pair_usable = (DTI_FM_AP_rows['usable'] != 0.0) & (DTI_FM_PA_rows['usable'] != 0.0)
+                DTI_FM_rows = concat_rows(select_rows(DTI_FM_AP_rows, pair_usable), select_rows(DTI_FM_PA_rows, pair_usable))
+        if count_rows(DTI_FM_rows):
+            file_paths.extend(DTI_rows['filename'].tolist())
+            file_paths.extend(DTI_FM_rows['filename'].tolist())
+        has_dti = count_rows(DTI_rows)
     else:
-        has_dti = DTI_df.shape[0]
+        has_dti = count_rows(DTI_rows)
 
     return (file_paths, has_dti)
 